@@ -4,12 +4,23 @@ Provides an endpoint for executing Python code with GPU support.
 """
 
 import os
+import re
 import sys
+import json
+import signal
+import selectors
+import marshal
+import hashlib
 import traceback
 import asyncio
-from io import StringIO
+import multiprocessing
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from importlib.metadata import distributions
+from time import perf_counter
 from typing import Optional, Any
-from contextlib import redirect_stdout, redirect_stderr
+from contextlib import asynccontextmanager
 
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from fastapi.middleware.cors import CORSMiddleware
@@ -18,10 +29,110 @@ from pydantic import BaseModel, Field
 # Get timeout from environment variable (default: 1 hour)
 PYTHON_EXECUTE_TIMEOUT = int(os.getenv("PYTHON_EXECUTE_TIMEOUT", "3600"))
 
+# Larger submissions are rejected during request validation
+MAX_CODE_LENGTH = int(os.getenv("MAX_CODE_LENGTH", "1000000"))
+
+# Per-stream cap on captured output; the oldest output is dropped first
+MAX_OUTPUT_BYTES = int(os.getenv("MAX_OUTPUT_BYTES", str(10 * 1024 * 1024)))
+
+# Dedicated pool for submitted code so long jobs can't starve asyncio's default executor
+CODE_EXEC_WORKERS = int(os.getenv("CODE_EXEC_WORKERS", "4"))
+CODE_EXEC_POOL = ThreadPoolExecutor(
+    max_workers=CODE_EXEC_WORKERS,
+    thread_name_prefix="codeexec"
+)
+
+
+def _parse_preload_modules(spec: str) -> tuple:
+    """
+    Parse a PRELOAD_MODULES spec such as "torch,numpy:np".
+    
+    Returns:
+        Modules to import, and a mapping of namespace name -> module name
+    """
+    imports = []
+    bindings = {}
+    for entry in spec.split(","):
+        module, _, alias = (part.strip() for part in entry.partition(":"))
+        if not module:
+            continue
+        imports.append(module)
+        if alias:
+            bindings[alias] = module
+        else:
+            # Same as a plain import statement: "a.b" binds the top-level package
+            top_level = module.partition(".")[0]
+            bindings[top_level] = top_level
+    return imports, bindings
+
+
+# Imported once in the worker fork server and exposed to submitted code, so
+# jobs don't pay for heavy imports themselves
+PRELOAD_MODULES = os.getenv("PRELOAD_MODULES", "torch,numpy:np")
+_PRELOAD_IMPORTS, _PRELOAD_BINDINGS = _parse_preload_modules(PRELOAD_MODULES)
+
+# Each submission runs in a fresh worker process so a timeout can actually stop it
+_MP_CONTEXT = multiprocessing.get_context("forkserver")
+_EXEC_SLOTS = asyncio.Semaphore(CODE_EXEC_WORKERS)
+
+# Recently compiled submissions, keyed by source digest so large sources aren't kept alive.
+# Marshalled code is roughly twice the source size, so the cache is bounded by bytes;
+# anything above the per-entry cap is compiled on every request instead.
+_COMPILE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+_COMPILE_CACHE_MAX_ENTRY_BYTES = 1024 * 1024
+_compile_cache: "OrderedDict[bytes, bytes]" = OrderedDict()
+_compile_cache_bytes = 0
+
+# GPU details, filled in once at startup by the lifespan handler
+_GPU_INFO = {"cuda_available": False}
+
+
+def _probe_gpu() -> dict:
+    """Query PyTorch for CUDA availability and the primary device."""
+    try:
+        import torch
+    except ImportError:
+        return {"cuda_available": False, "note": "PyTorch not installed"}
+    
+    cuda_available = torch.cuda.is_available()
+    return {
+        "cuda_available": cuda_available,
+        "cuda_version": torch.version.cuda if cuda_available else None,
+        "gpu_count": torch.cuda.device_count() if cuda_available else 0,
+        "gpu_name": torch.cuda.get_device_name(0) if cuda_available else None
+    }
+
+
+def _warm_up_fork_server() -> None:
+    """
+    Start and reap a no-op worker.
+    
+    Launching the fork server doesn't wait for it to import the preloaded
+    modules; the first worker start does. Pay for that here rather than in
+    the first execution request.
+    """
+    process = _MP_CONTEXT.Process()
+    process.start()
+    process.join()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Import torch and probe the GPU once, before serving requests."""
+    _GPU_INFO.update(_probe_gpu())
+    # Workers fork from a server that already imported these plus this module.
+    # CUDA is left uninitialised there since a CUDA context can't survive fork.
+    _MP_CONTEXT.set_forkserver_preload([*_PRELOAD_IMPORTS, __name__])
+    await asyncio.to_thread(_warm_up_fork_server)
+    yield
+    CODE_EXEC_POOL.shutdown(wait=False, cancel_futures=True)
+
+
 app = FastAPI(
     title="GPU Code Execution API",
     description="Execute Python code on Salad Cloud GPU instances",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 # CORS middleware for API access
@@ -36,7 +147,7 @@ app.add_middleware(
 
 class CodeExecutionRequest(BaseModel):
     """Request model for code execution."""
-    code: str = Field(..., description="Python code to execute")
+    code: str = Field(..., max_length=MAX_CODE_LENGTH, description="Python code to execute")
     timeout: Optional[int] = Field(
         default=None,
         description=f"Execution timeout in seconds (default: {PYTHON_EXECUTE_TIMEOUT})"
@@ -53,9 +164,252 @@ class CodeExecutionResponse(BaseModel):
     execution_time: float
 
 
+class InstanceInfoResponse(BaseModel):
+    """Response model for instance info."""
+    python_version: str
+    gpu_info: dict
+    installed_packages: list
+    environment: dict
+
+
+@lru_cache(maxsize=1)
+def _installed_packages() -> tuple:
+    """Enumerate installed distributions once; the environment is fixed at build time."""
+    packages = {}
+    for dist in distributions():
+        name = dist.metadata.get("Name")
+        # Broken dist-info can lack a name
+        if not name:
+            continue
+        # A distribution is listed once per sys.path entry; keep the first, as import does
+        key = re.sub(r"[-_.]+", "-", name).lower()
+        packages.setdefault(key, {"name": name, "version": dist.version})
+    return tuple(packages.values())
+
+
+def _json_safe(value):
+    """
+    Reduce a result to plain JSON data inside the worker.
+    
+    The server must never unpickle anything the worker sends, since that would
+    let submitted code run in the server process.
+    """
+    try:
+        return json.loads(json.dumps(value, default=repr))
+    except Exception:
+        try:
+            return repr(value)
+        except Exception:
+            return f"<unrepresentable {type(value).__name__}>"
+
+
+def _compile(code: str) -> bytes:
+    """Compile code into a marshalled code object, reusing recent results."""
+    global _compile_cache_bytes
+    key = hashlib.blake2b(code.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    code_bytes = _compile_cache.get(key)
+    if code_bytes is not None:
+        _compile_cache.move_to_end(key)
+        return code_bytes
+    
+    code_bytes = marshal.dumps(compile(code, "<string>", "exec"))
+    if len(code_bytes) > _COMPILE_CACHE_MAX_ENTRY_BYTES:
+        return code_bytes
+    
+    _compile_cache[key] = code_bytes
+    _compile_cache_bytes += len(code_bytes)
+    while _compile_cache_bytes > _COMPILE_CACHE_MAX_BYTES:
+        _, evicted = _compile_cache.popitem(last=False)
+        _compile_cache_bytes -= len(evicted)
+    return code_bytes
+
+
+def _build_exec_globals_template() -> dict:
+    """Base namespace for submitted code, with the preloaded modules bound."""
+    template = {
+        "__builtins__": __builtins__,
+        "__name__": "__main__",
+    }
+    for name, module in _PRELOAD_BINDINGS.items():
+        if module in sys.modules:
+            template[name] = sys.modules[module]
+    return template
+
+
+# The fork server imports this module after the preloaded modules, so workers
+# inherit a template that already contains them. Each run gets a shallow copy;
+# shared objects like modules could be mutated by the code, but every run is
+# its own process, so such changes never reach the next one.
+_EXEC_GLOBALS_TEMPLATE = _build_exec_globals_template()
+
+
+class _OutputCapture:
+    """
+    Collect what a worker writes to one of its output streams.
+    
+    The worker's file descriptor points at a pipe whose read end stays in the
+    server, so output written before a timeout, kill or crash is kept. Unlike
+    redirect_stdout this also sees output from C extensions (CUDA, FluidSynth,
+    ...) that write to the descriptor directly. Only the last MAX_OUTPUT_BYTES
+    are kept.
+    """
+    
+    def __init__(self):
+        self._chunks = deque()
+        self._size = 0
+        self._truncated = False
+    
+    def feed(self, chunk: bytes):
+        self._chunks.append(chunk)
+        self._size += len(chunk)
+        while self._size > MAX_OUTPUT_BYTES and len(self._chunks) > 1:
+            self._size -= len(self._chunks.popleft())
+            self._truncated = True
+    
+    def getvalue(self) -> str:
+        text = b"".join(self._chunks).decode("utf-8", "replace")
+        if self._truncated:
+            text = "[earlier output truncated]\n" + text
+        return text
+
+
+def _exec_worker(code_bytes: bytes, conn, stdout_conn, stderr_conn) -> None:
+    """
+    Entry point of a code execution worker process.
+    
+    Args:
+        code_bytes: Marshalled code object to execute
+        conn: Write end of the pipe used to report back to the server
+        stdout_conn: Write end of the pipe that becomes the worker's stdout
+        stderr_conn: Write end of the pipe that becomes the worker's stderr
+    """
+    # Lead a new process group, so killing the worker also kills anything it started
+    os.setsid()
+    # Descriptors handed over by the fork server arrive inheritable; a child
+    # holding this one open would keep the server waiting for the outcome
+    os.set_inheritable(conn.fileno(), False)
+    
+    # Children started by the code inherit these, so their output is captured too
+    for stream, pipe in ((sys.stdout, stdout_conn), (sys.stderr, stderr_conn)):
+        stream.flush()
+        os.dup2(pipe.fileno(), stream.fileno())
+        pipe.close()
+    
+    result = None
+    error = None
+    success = False
+    
+    # Create a namespace for code execution
+    exec_globals = _EXEC_GLOBALS_TEMPLATE.copy()
+    
+    try:
+        exec(marshal.loads(code_bytes), exec_globals)
+        success = True
+    except SystemExit as e:
+        # sys.exit() ends the submitted code, not the worker
+        if e.code in (0, None):
+            success = True
+        else:
+            error = f"SystemExit: exit code {e.code}"
+    except BaseException as e:
+        # Start the traceback at the submitted code rather than this wrapper
+        frames = traceback.format_exception(type(e), e, e.__traceback__.tb_next)
+        error = f"{type(e).__name__}: {str(e)}\n{''.join(frames)}"
+    
+    # Check if there's a 'result' variable in the namespace
+    if success and 'result' in exec_globals:
+        result = exec_globals['result']
+    
+    # The server kills the worker as soon as the outcome arrives, so nothing
+    # may be left in the stream buffers by then
+    for stream in (sys.__stdout__, sys.__stderr__):
+        try:
+            stream.flush()
+        except (OSError, ValueError):
+            pass
+    
+    outcome = {
+        "success": success,
+        "result": _json_safe(result),
+        "error": error
+    }
+    with conn:
+        conn.send_bytes(json.dumps(outcome).encode("utf-8"))
+
+
+def _kill_worker(process) -> None:
+    """Kill a worker along with every process it started."""
+    try:
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        # The whole group is already gone
+        pass
+    # Covers a worker killed before it got to os.setsid()
+    process.kill()
+
+
+def _collect_outcome(process, conn, outputs: dict) -> Optional[dict]:
+    """
+    Drain a worker's output pipes until it is gone, then reap it.
+    
+    Args:
+        process: Worker process
+        conn: Read end of the pipe the worker reports back on
+        outputs: Read end of each output pipe -> _OutputCapture it feeds
+        
+    Returns:
+        The outcome the worker reported, or None if it died first
+    """
+    outcome = None
+    deadline = None
+    with selectors.DefaultSelector() as selector:
+        selector.register(conn, selectors.EVENT_READ, "outcome")
+        selector.register(process.sentinel, selectors.EVENT_READ, "exit")
+        for pipe, capture in outputs.items():
+            selector.register(pipe, selectors.EVENT_READ, capture)
+        
+        while selector.get_map():
+            wait = None if deadline is None else max(deadline - perf_counter(), 0)
+            events = selector.select(wait)
+            if not events:
+                # Only processes that left the worker's group still hold the pipes
+                break
+            for key, _ in events:
+                if key.data == "outcome":
+                    selector.unregister(conn)
+                    try:
+                        # Plain JSON only; never unpickle data produced by submitted code
+                        outcome = json.loads(conn.recv_bytes())
+                    except EOFError:
+                        continue
+                    # Don't let threads or children left behind by user code live on
+                    _kill_worker(process)
+                elif key.data == "exit":
+                    selector.unregister(process.sentinel)
+                    # Children still holding the output pipes go with the worker
+                    _kill_worker(process)
+                    deadline = perf_counter() + 1
+                else:
+                    chunk = os.read(key.fd, 65536)
+                    if chunk:
+                        key.data.feed(chunk)
+                    else:
+                        selector.unregister(key.fileobj)
+    
+    for pipe in (conn, *outputs):
+        pipe.close()
+    process.join()
+    return outcome
+
+
 async def execute_code_with_timeout(code: str, timeout: int) -> dict:
     """
-    Execute Python code with a timeout.
+    Execute Python code in a worker process with a timeout.
+    
+    The timeout also covers waiting for a free execution slot. The worker is
+    killed once the timeout expires (or the request is cancelled), so runaway
+    code can't keep holding CPU, RAM or VRAM. Output written up to that point
+    is still returned.
     
     Args:
         code: Python code string to execute
@@ -64,52 +418,83 @@ async def execute_code_with_timeout(code: str, timeout: int) -> dict:
     Returns:
         Dictionary with execution results
     """
-    import time
-    start_time = time.time()
+    worker_started = None
+    stdout_capture = _OutputCapture()
+    stderr_capture = _OutputCapture()
+    
+    async def run_worker(code_bytes: bytes) -> tuple:
+        nonlocal worker_started
+        async with _EXEC_SLOTS:
+            recv_conn, send_conn = _MP_CONTEXT.Pipe(duplex=False)
+            stdout_recv, stdout_send = _MP_CONTEXT.Pipe(duplex=False)
+            stderr_recv, stderr_send = _MP_CONTEXT.Pipe(duplex=False)
+            process = _MP_CONTEXT.Process(
+                target=_exec_worker,
+                args=(code_bytes, send_conn, stdout_send, stderr_send)
+            )
+            # Starting a worker waits on the fork server; keep that off the event loop
+            worker_started = perf_counter()
+            starting = asyncio.ensure_future(asyncio.to_thread(process.start))
+            try:
+                await asyncio.shield(starting)
+            except asyncio.CancelledError:
+                # Timed out mid-start: let it finish so the worker can still be killed
+                await asyncio.wait([starting])
+                if process.pid is not None:
+                    _kill_worker(process)
+                raise
+            for pipe in (send_conn, stdout_send, stderr_send):
+                pipe.close()
+            
+            # Block on a pool thread so the event loop stays free
+            collected = asyncio.wrap_future(CODE_EXEC_POOL.submit(
+                _collect_outcome,
+                process,
+                recv_conn,
+                {stdout_recv: stdout_capture, stderr_recv: stderr_capture}
+            ))
+            try:
+                outcome = await asyncio.shield(collected)
+            finally:
+                # Also catches children of a worker that already exited
+                _kill_worker(process)
+                # On timeout, wait for the pipes to drain so partial output is kept
+                await asyncio.wait([collected])
+        return outcome, process.exitcode
     
-    stdout_capture = StringIO()
-    stderr_capture = StringIO()
     result = None
     error = None
     success = False
     
-    # Create a namespace for code execution
-    exec_globals = {
-        "__builtins__": __builtins__,
-        "__name__": "__main__",
-    }
-    
     try:
         # Compile the code first to catch syntax errors
-        compiled_code = compile(code, "<string>", "exec")
+        code_bytes = _compile(code)
         
-        # Execute with output capture
-        with redirect_stdout(stdout_capture), redirect_stderr(stderr_capture):
-            # Run in a thread pool to allow timeout
-            loop = asyncio.get_event_loop()
-            await asyncio.wait_for(
-                loop.run_in_executor(
-                    None,
-                    exec,
-                    compiled_code,
-                    exec_globals
-                ),
-                timeout=timeout
-            )
+        if sys.version_info >= (3, 11):
+            async with asyncio.timeout(timeout):
+                outcome, exitcode = await run_worker(code_bytes)
+        else:
+            outcome, exitcode = await asyncio.wait_for(run_worker(code_bytes), timeout=timeout)
         
-        success = True
-        # Check if there's a 'result' variable in the namespace
-        if 'result' in exec_globals:
-            result = exec_globals['result']
+        if outcome is None:
+            error = f"Execution process exited unexpectedly (exit code {exitcode})"
+        else:
+            success = outcome["success"]
+            result = outcome["result"]
+            error = outcome["error"]
             
     except asyncio.TimeoutError:
-        error = f"Execution timed out after {timeout} seconds"
+        if worker_started is None:
+            error = f"Execution timed out after {timeout} seconds waiting for a free execution slot"
+        else:
+            error = f"Execution timed out after {timeout} seconds"
     except SyntaxError as e:
         error = f"Syntax error: {e}"
     except Exception as e:
         error = f"{type(e).__name__}: {str(e)}\n{traceback.format_exc()}"
     
-    execution_time = time.time() - start_time
+    # Time spent queued for a slot is not execution time
+    execution_time = perf_counter() - worker_started if worker_started is not None else 0.0
     
     return {
         "success": success,
@@ -122,7 +507,7 @@ async def execute_code_with_timeout(code: str, timeout: int) -> dict:
 
 
 @app.get("/")
-async def root():
+def root():
     """Health check endpoint."""
     return {
         "status": "online",
@@ -132,17 +517,12 @@ async def root():
 
 
 @app.get("/health")
-async def health_check():
+def health_check():
     """Detailed health check."""
-    import torch
-    
-    gpu_available = torch.cuda.is_available() if 'torch' in sys.modules else False
-    gpu_name = torch.cuda.get_device_name(0) if gpu_available else "N/A"
-    
     return {
         "status": "healthy",
-        "gpu_available": gpu_available,
-        "gpu_name": gpu_name,
+        "gpu_available": _GPU_INFO["cuda_available"],
+        "gpu_name": _GPU_INFO.get("gpu_name") or "N/A",
         "python_version": sys.version,
         "timeout_setting": PYTHON_EXECUTE_TIMEOUT
     }
@@ -160,47 +540,31 @@ async def execute_python_code(request: CodeExecutionRequest):
     - **code**: The Python code to execute
     - **timeout**: Optional custom timeout (uses PYTHON_EXECUTE_TIMEOUT env var if not set)
     """
+    # Reject blank code before doing anything else; isspace() avoids copying like strip()
+    if not request.code or request.code.isspace():
+        raise HTTPException(status_code=400, detail="No code provided")
+    
     # Use custom timeout or default
     timeout = request.timeout or PYTHON_EXECUTE_TIMEOUT
     
     # Cap timeout at environment maximum for safety
     timeout = min(timeout, PYTHON_EXECUTE_TIMEOUT)
     
-    if not request.code.strip():
-        raise HTTPException(status_code=400, detail="No code provided")
-    
     # Execute the code
     result = await execute_code_with_timeout(request.code, timeout)
     
-    return CodeExecutionResponse(**result)
+    # Return the dict as-is: response_model already validates it once while
+    # serializing, so building a CodeExecutionResponse here would be a second pass
+    return result
 
 
-@app.get("/v1/info")
-async def get_instance_info():
+@app.get("/v1/info", response_model=InstanceInfoResponse)
+def get_instance_info():
     """Get information about the GPU instance and available libraries."""
-    import pkg_resources
-    
-    installed_packages = [
-        {"name": pkg.key, "version": pkg.version}
-        for pkg in pkg_resources.working_set
-    ]
-    
-    # Check for GPU
-    try:
-        import torch
-        gpu_info = {
-            "cuda_available": torch.cuda.is_available(),
-            "cuda_version": torch.version.cuda if torch.cuda.is_available() else None,
-            "gpu_count": torch.cuda.device_count() if torch.cuda.is_available() else 0,
-            "gpu_name": torch.cuda.get_device_name(0) if torch.cuda.is_available() else None
-        }
-    except ImportError:
-        gpu_info = {"cuda_available": False, "note": "PyTorch not installed"}
-    
     return {
         "python_version": sys.version,
-        "gpu_info": gpu_info,
-        "installed_packages": installed_packages,
+        "gpu_info": _GPU_INFO,
+        "installed_packages": _installed_packages(),
         "environment": {
             "PYTHON_EXECUTE_TIMEOUT": PYTHON_EXECUTE_TIMEOUT,
             "SOUNDFONT_PATH": os.getenv("SOUNDFONT_PATH", "Not set")
@@ -210,4 +574,11 @@ async def get_instance_info():
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.getenv("WEB_CONCURRENCY", "2"))
+    )
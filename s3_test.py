@@ -14,9 +14,12 @@ Usage:
 
 import os
 import sys
+import functools
+import itertools
 from datetime import datetime
 
 import boto3
+from botocore.config import Config
 from botocore.exceptions import ClientError, NoCredentialsError
 
 # Configuration from environment variables
@@ -26,19 +29,51 @@ AWS_REGION = os.getenv("AWS_REGION", "us-east-1")
 S3_ENDPOINT_URL = os.getenv("S3_ENDPOINT_URL")  # Optional for S3-compatible storage
 BUCKET_NAME = os.getenv("S3_BUCKET_NAME", "narrated")
 
+# Write-test object; the timestamp only goes into the key
+TEST_KEY_PREFIX = "_test/connectivity_test_"
+TEST_PAYLOAD = b"S3 connectivity test object"
+
+# Larger connection pool than botocore's default of 10 so parallel transfers don't queue
+CLIENT_CONFIG = Config(
+    max_pool_connections=50,
+    retries={"max_attempts": 3, "mode": "adaptive"},
+    tcp_keepalive=True,
+)
+
+
+@functools.lru_cache(maxsize=4)
+def _cached_client(access_key, secret_key, region, endpoint_url):
+    """Build an S3 client once per credential set; construction is expensive."""
+    return boto3.client(
+        "s3",
+        aws_access_key_id=access_key,
+        aws_secret_access_key=secret_key,
+        region_name=region,
+        endpoint_url=endpoint_url,
+        config=CLIENT_CONFIG,
+    )
+
 
 def get_s3_client():
-    """Create and return an S3 client with configured credentials."""
-    config = {
-        "aws_access_key_id": AWS_ACCESS_KEY_ID,
-        "aws_secret_access_key": AWS_SECRET_ACCESS_KEY,
-        "region_name": AWS_REGION,
-    }
-    
-    if S3_ENDPOINT_URL:
-        config["endpoint_url"] = S3_ENDPOINT_URL
-    
-    return boto3.client("s3", **config)
+    """Return an S3 client for the configured credentials, reused across calls."""
+    return _cached_client(
+        AWS_ACCESS_KEY_ID,
+        AWS_SECRET_ACCESS_KEY,
+        AWS_REGION,
+        S3_ENDPOINT_URL or None,
+    )
+
+
+def iter_objects(s3, bucket, prefix="", page_size=1000):
+    """Yield objects in a bucket, fetching further pages only as they're consumed."""
+    paginator = s3.get_paginator("list_objects_v2")
+    pages = paginator.paginate(
+        Bucket=bucket,
+        Prefix=prefix,
+        PaginationConfig={"PageSize": page_size},
+    )
+    for page in pages:
+        yield from page.get("Contents", [])
 
 
 def test_connection():
@@ -100,24 +135,21 @@ def test_connection():
         
         # Test 3: List objects in bucket
         print(f"\n[Test 3] Listing objects in '{BUCKET_NAME}'...")
-        response = s3.list_objects_v2(Bucket=BUCKET_NAME, MaxKeys=10)
-        object_count = response.get('KeyCount', 0)
-        print(f"✓ Listed objects. Found {object_count} objects (showing max 10)")
+        objects = list(itertools.islice(iter_objects(s3, BUCKET_NAME, page_size=10), 10))
+        print(f"✓ Listed objects. Found {len(objects)} objects (showing max 10)")
         
-        if 'Contents' in response:
-            for obj in response['Contents'][:5]:
-                print(f"   - {obj['Key']} ({obj['Size']} bytes)")
+        for obj in objects[:5]:
+            print(f"   - {obj['Key']} ({obj['Size']} bytes)")
         
         # Test 4: Write test (optional)
         print(f"\n[Test 4] Testing write access...")
-        test_key = f"_test/connectivity_test_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        test_content = f"Connectivity test at {datetime.now().isoformat()}"
+        test_key = f"{TEST_KEY_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
         
         try:
             s3.put_object(
                 Bucket=BUCKET_NAME,
                 Key=test_key,
-                Body=test_content.encode('utf-8'),
+                Body=TEST_PAYLOAD,
                 ContentType='text/plain'
             )
             print(f"✓ Successfully wrote test file: {test_key}")